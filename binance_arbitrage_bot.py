@@ -1,26 +1,64 @@
+import asyncio
+import atexit
+import math
 import os
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import gspread
 import json
+import numpy as np
+import queue
+import hmac
 from binance.client import Client
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+from functools import wraps
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
 import requests
-import websocket
+import websockets
+from collections import Counter, defaultdict, deque
+
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:  # orjson 未安裝時退回標準庫
+    orjson = None
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+try:
+    from numba import njit
+except ImportError:  # numba 未安裝時退回純 Python 實作
+    def njit(*args, **kwargs):
+        def wrapper(func):
+            return func
+        return wrapper
+
+try:
+    import uvloop
+except ImportError:  # uvloop 未安裝時使用預設事件迴圈
+    uvloop = None
 from datetime import datetime
 import traceback
 
 # ✅ 常量定義
 TRADE_FEE = 0.00075  # 交易手續費
+FEE_MULT = 1.0 - TRADE_FEE  # 每一腿成交後剩餘的比例，熱路徑不重算
 SLIPPAGE_TOLERANCE = 0.002  # 滑點容忍度
 MIN_PROFIT_THRESHOLD = 0.001  # 最小利潤閾值
 MIN_TRADE_AMOUNT = 10  # 最小交易金額(USDT)
 MAX_TRADE_AMOUNT = 1000  # 最大交易金額(USDT)
 WEBSOCKET_PING_INTERVAL = 30  # WebSocket心跳間隔
 PRICE_CHANGE_THRESHOLD = 0.01  # 價格變動閾值(1%)
+MIN_QUOTE_VOLUME = 100000  # 篩選條件: 最小24小時成交額(USDT)
+MIN_PRICE_CHANGE_PCT = 1.0  # 篩選條件: 最小24小時漲跌幅(%)
+MIN_VOLATILITY = 0.001  # 篩選條件: 最小波動率(標準差/均價)
+MIN_VOLATILITY_SAMPLES = 30  # 波動率計算所需的最少價格筆數
+PRICE_STALENESS_LIMIT = 60  # 價格最大容許延遲(秒)，超過視為行情斷線不交易
 
 # ✅ 交易路徑設置
 TRADE_PATHS = [
@@ -31,6 +69,41 @@ TRADE_PATHS = [
 
 # ✅ 初始化日誌處理
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logging.getLogger('websockets').setLevel(logging.WARNING)  # 關掉函式庫逐訊息的 DEBUG 雜訊
+
+def log_exception(message):
+    # 完整 traceback 只在 DEBUG 等級展開; 錯誤風暴時不為每次重試走訪整條堆疊
+    logging.error(message)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(traceback.format_exc())
+
+# ✅ 延遲量測 (行情處理→路徑決策→下單往返各階段耗時，沒有量測就無從驗證優化)
+LATENCY_REPORT_INTERVAL = 60  # 彙總輸出間隔(秒)
+
+latency_stats = defaultdict(Counter)  # 階段 -> {毫秒: 次數}
+
+def record_latency(stage, started_ns):
+    ms = (time.perf_counter_ns() - started_ns) // 1_000_000
+    latency_stats[stage][ms] += 1
+
+def report_latency():
+    while True:
+        time.sleep(LATENCY_REPORT_INTERVAL)
+        for stage, buckets in list(latency_stats.items()):
+            total = sum(buckets.values())
+            if not total:
+                continue
+            acc = 0
+            p50 = 0
+            for ms in sorted(buckets):
+                acc += buckets[ms]
+                if acc * 2 >= total:
+                    p50 = ms
+                    break
+            logging.info(f"⏱ {stage}: {total} 次, 中位數 {p50}ms, 最大 {max(buckets)}ms")
+            buckets.clear()
+
+threading.Thread(target=report_latency, daemon=True).start()
 
 # ✅ 檢查環境變數
 def check_env_vars():
@@ -43,46 +116,197 @@ def check_env_vars():
     if missing_vars:
         raise EnvironmentError(f"缺少環境變數: {', '.join(missing_vars)}")
 
-# ✅ Telegram 日誌處理器
+# ✅ REST 請求限速 (Binance 權重上限 1200/分鐘，在本地先擋下超速請求)
+API_RATE_LIMIT = 1100  # 每分鐘允許的請求權重，預留安全邊際
+API_RATE_WINDOW = 60  # 限速視窗(秒)
+
+class RateLimiter:
+    def __init__(self, max_weight, time_window):
+        self.max_weight = max_weight
+        self.time_window = time_window
+        self.requests = deque()  # (時間, 權重)，最舊的在左端
+        self.used = 0
+        self.cv = threading.Condition()
+
+    def acquire(self, weight=1):
+        with self.cv:
+            while True:
+                now = time.monotonic()
+                # 只從左端彈出過期紀錄，攤提後每次呼叫 O(1)
+                while self.requests and now - self.requests[0][0] >= self.time_window:
+                    self.used -= self.requests.popleft()[1]
+                if self.used + weight <= self.max_weight:
+                    self.requests.append((now, weight))
+                    self.used += weight
+                    return
+                # 精確睡到最舊一筆過期、配額釋出的那一刻，不做固定間隔輪詢
+                self.cv.wait(timeout=self.time_window - (now - self.requests[0][0]))
+
+rate_limiter = RateLimiter(API_RATE_LIMIT, API_RATE_WINDOW)
+
+def safe_api_call(func, *args, weight=1, **kwargs):
+    rate_limiter.acquire(weight)
+    return func(*args, **kwargs)
+
+# ✅ exchange_info 快取 (回應超過 1MB，交易對清單一天才變動一次，不必每次重抓)
+EXCHANGE_INFO_TTL = 3600  # 快取有效時間(秒)
+_exchange_info_cache = {'time': 0, 'value': None, 'usdt_symbols': frozenset(), 'tradable_symbols': frozenset(), 'rules': {}}
+
+def get_exchange_info():
+    now = time.time()
+    if _exchange_info_cache['value'] is None or now - _exchange_info_cache['time'] > EXCHANGE_INFO_TTL:
+        info = safe_api_call(client.get_exchange_info, weight=10)
+        # 以 quoteAsset 判斷並排除停牌交易對，隨 exchange_info 快取一起更新
+        _exchange_info_cache['usdt_symbols'] = frozenset(
+            s['symbol'].lower() for s in info['symbols']
+            if s['quoteAsset'] == 'USDT' and s['status'] == 'TRADING'
+        )
+        _exchange_info_cache['tradable_symbols'] = frozenset(
+            s['symbol'] for s in info['symbols'] if s['status'] == 'TRADING'
+        )
+        # 各交易對的下單規則: LOT_SIZE 的 stepSize 與報價資產小數位，下單前對齊用
+        rules = {}
+        for s in info['symbols']:
+            if s['status'] != 'TRADING':
+                continue
+            step = 0.0
+            for f in s['filters']:
+                if f['filterType'] == 'LOT_SIZE':
+                    step = float(f['stepSize'])
+                    break
+            rules[s['symbol']] = (step, s.get('quoteAssetPrecision', 8))
+        _exchange_info_cache['rules'] = rules
+        _exchange_info_cache['value'] = info
+        _exchange_info_cache['time'] = now
+    return _exchange_info_cache['value']
+
+def get_symbol_rules(pair):
+    get_exchange_info()
+    return _exchange_info_cache['rules'].get(pair.upper(), (0.0, 8))
+
+def quantize_quote(pair, amount):
+    # quoteOrderQty 依該交易對報價資產的小數位無條件捨去，不假設報價資產是 USDT
+    _, precision = get_symbol_rules(pair)
+    scale = 10 ** precision
+    return round(math.floor(amount * scale) / scale, precision)
+
+def quantize_base(pair, quantity):
+    # 數量向下對齊 LOT_SIZE 的 stepSize (常比 1e-6 粗)，避免 Filter failure 拒單；
+    # 最後再捨入到 8 位，去掉浮點殘差，送出的才是 stepSize 的整數倍
+    step, _ = get_symbol_rules(pair)
+    if step <= 0:
+        return quantity
+    return round(math.floor(quantity / step) * step, 8)
+
+def get_usdt_symbols():
+    get_exchange_info()
+    return _exchange_info_cache['usdt_symbols']
+
+def is_pair_tradable(pair):
+    get_exchange_info()
+    return pair.upper() in _exchange_info_cache['tradable_symbols']
+
+def refresh_exchange_info():
+    # 背景定期更新，熱路徑永遠命中快取，不會卡在 1MB 的重新下載上
+    while True:
+        time.sleep(EXCHANGE_INFO_TTL)
+        try:
+            _exchange_info_cache['time'] = 0
+            get_exchange_info()
+        except Exception as e:
+            logging.error(f"更新 exchange_info 失敗: {str(e)}")
+
+# ✅ 共用 HTTP 連線池 (對外請求走同一個 Session，免去每次 TCP+TLS 握手)
+http_session = requests.Session()
+http_session.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=4, pool_maxsize=8,
+    max_retries=requests.adapters.Retry(total=3, backoff_factor=0.5)
+))
+
+# ✅ 共用執行緒池 (並行的 IO 任務: 歷史預填、各腿預檢、餘額查詢)
+executor = ThreadPoolExecutor(max_workers=8)
+
+# ✅ Telegram 日誌處理器 (訊息先進佇列，背景執行緒合併送出，日誌呼叫不被網路卡住)
+TELEGRAM_BATCH_INTERVAL = 0.5  # 收到第一則訊息後最多等多久就送出(秒)
+TELEGRAM_BATCH_MAX_CHARS = 3500  # 合併後的長度上限，保留餘裕不超過 Telegram 的 4096
+TELEGRAM_QUEUE_MAX = 50  # 佇列上限；Telegram 限流時寧可丟日誌也不讓佇列無限堆積
+
 class TelegramLoggingHandler(logging.Handler):
     def __init__(self, token, chat_id):
         super().__init__()
         self.token = token
         self.chat_id = chat_id
-        
+        self.queue = queue.Queue(maxsize=TELEGRAM_QUEUE_MAX)
+        threading.Thread(target=self._drain_queue, daemon=True).start()
+
     def emit(self, record):
         log_message = f"🔔 {record.levelname}\n{self.format(record)}\n🕒 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-        self.send_telegram_message(log_message)
+        try:
+            self.queue.put_nowait(log_message)
+        except queue.Full:  # 積壓過多時丟棄，日誌永遠不反壓交易主迴圈
+            pass
+
+    def _drain_queue(self):
+        while True:
+            # 等到第一則訊息後再湊批: 連發的日誌合併成一則，上限內盡量塞
+            messages = [self.queue.get()]
+            total = len(messages[0])
+            deadline = time.monotonic() + TELEGRAM_BATCH_INTERVAL
+            while total < TELEGRAM_BATCH_MAX_CHARS:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    message = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                messages.append(message)
+                total += len(message) + 1
+            self.send_telegram_message("\n".join(messages)[:4096])
 
     def send_telegram_message(self, message):
         try:
-            requests.post(f"https://api.telegram.org/bot{self.token}/sendMessage", json={
+            payload = json_dumps({
                 "chat_id": self.chat_id,
                 "text": message,
                 "parse_mode": "HTML"
-            }, timeout=5)
+            })
+            http_session.post(f"https://api.telegram.org/bot{self.token}/sendMessage",
+                              data=payload, headers={'Content-Type': 'application/json'}, timeout=5)
         except requests.exceptions.RequestException as e:
             print(f"Telegram發送失敗: {e}")
 
+# ✅ Flask JSON 序列化改走 orjson (可用時)，jsonify 的編碼成本降數倍
+class ORJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # ✅ 初始化系統
 try:
     check_env_vars()
-    
+
     app = Flask(__name__)
+    if orjson is not None:
+        app.json = ORJSONProvider(app)
 
     client = Client(os.getenv("BINANCE_API_KEY"), os.getenv("BINANCE_API_SECRET"), testnet=True)
 
-    # 獲取可用交易對並檢查所需的交易對是否存在
-    exchange_info = client.get_exchange_info()
-    symbols = [s['symbol'] for s in exchange_info['symbols']]
-    logging.info("可用的交易對: %s", symbols)
+    # 擴大連線池並保持連線，避免多執行緒下每個 REST 請求重做 TLS 握手
+    adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=64)
+    client.session.mount('https://', adapter)
+    client.session.headers['Connection'] = 'keep-alive'
+
+    # 先 ping 一次暖連線: DNS 解析和 TLS 握手 (~150-300ms) 在啟動時付掉，
+    # 不讓第一筆下單請求扛
+    client.ping()
 
-    required_symbols = ['USDTBNB', 'USDTBTC', 'BTCUSDT', 'ETHUSDT']
-    missing_symbols = [symbol for symbol in required_symbols if symbol not in symbols]
-    if missing_symbols:
-        raise ValueError(f"缺少必要的交易對: {', '.join(missing_symbols)}")
+    # 先抓一次交易對清單讓快取就緒，路徑解析時直接使用
+    get_exchange_info()
 
-    creds_info = json.loads(os.getenv('GOOGLE_CREDENTIALS_JSON'))
+    creds_info = json_loads(os.getenv('GOOGLE_CREDENTIALS_JSON'))
     creds = service_account.Credentials.from_service_account_info(creds_info, scopes=['https://www.googleapis.com/auth/spreadsheets'])
     gsheet = gspread.authorize(creds).open_by_key(os.getenv("GOOGLE_SHEET_ID")).sheet1
 
@@ -97,97 +321,683 @@ except Exception as e:
     print(error_msg)
     raise
 
-# ✅ WebSocket 監聽價格
-prices = {}
+# ✅ WebSocket 監聽價格 (全市場 miniTicker 推送，本地維護最新行情)
+PRICE_HISTORY_SIZE = 500  # 每個交易對保留的價格筆數
 
-def on_message(ws, message):
-    try:
-        data = json.loads(message)
+opportunity_event = threading.Event()  # 價格明顯變動時喚醒主循環
 
-        if 's' in data and 'c' in data:
-            symbol = data['s'].lower()
-            price = float(data['c'])
-            prices[symbol] = price
-            logging.info(f"📈 {symbol.upper()} 最新價格: {price}")
+prices = {}
+price_updated_at = {}  # 每個交易對最後一次收到報價的時間
+bids = {}  # 簿頂買一價，賣出時的成交價
+asks = {}  # 簿頂賣一價，買入時的成交價
+volumes = {}  # 24小時成交額(USDT)
+day_opens = {}  # 24小時開盤價，用於計算漲跌幅
+price_history = defaultdict(lambda: deque(maxlen=PRICE_HISTORY_SIZE))
+running_stats = defaultdict(lambda: [0, 0.0, 0.0])  # (筆數, 均價, M2)，隨每筆報價增量更新
+
+def update_running_stats(symbol, price):
+    # 滑動視窗版 Welford: 視窗滿了就同時移除最舊一筆，維持「最近 N 筆」的統計
+    history = price_history[symbol]
+    stats = running_stats[symbol]
+    n, mean, m2 = stats
+    if len(history) == history.maxlen:
+        old = history[0]
+        new_mean = mean + (price - old) / n
+        m2 += (price - old) * (price - new_mean + old - mean)
+        mean = new_mean
+    else:
+        n += 1
+        d = price - mean
+        mean += d / n
+        m2 += d * (price - mean)
+    history.append(price)
+    stats[0], stats[1], stats[2] = n, mean, max(m2, 0.0)
+
+# 把每條路徑預先解析成 (交易對, 是否反向) 清單，熱路徑內不再做字串組裝與二次字典試探
+def compile_paths():
+    compiled = {}
+    for path in TRADE_PATHS:
+        pairs = []
+        for a, b in zip(path, path[1:]):
+            if is_pair_tradable(f"{a}{b}"):
+                pairs.append((f"{a}{b}".lower(), False))
+            elif is_pair_tradable(f"{b}{a}"):
+                # 只有反向交易對掛牌時，改以 1/價格 換算
+                pairs.append((f"{b}{a}".lower(), True))
+            else:
+                logging.warning(f"⚠️ 路徑 {' → '.join(path)} 缺少交易對 {a}{b}/{b}{a}，停用此路徑")
+                pairs = None
+                break
+        if pairs:
+            compiled[tuple(path)] = pairs
+    return compiled
+
+PATH_PAIRS = compile_paths()
+PATH_LABELS = {path: ' → '.join(path) for path in PATH_PAIRS}  # 顯示字串一次組好，日誌與紀錄共用
+
+# 只記錄套利路徑會用到的交易對，避免全市場推送洗版日誌
+TRACKED_SYMBOLS = {pair for pairs in PATH_PAIRS.values() for pair, _ in pairs}
+
+# 路徑掃描向量化: 追蹤的交易對編上索引，對數價格存進 NumPy 陣列，
+# 所有路徑的報酬用一次矩陣運算求出，路徑數成長時不增加 Python 迴圈成本
+SYMBOL_IDX = {pair: i for i, pair in enumerate(sorted(TRACKED_SYMBOLS))}
+PATH_LIST = list(PATH_PAIRS)
+PATH_INDEX = np.array([[SYMBOL_IDX[pair] for pair, _ in PATH_PAIRS[p]] for p in PATH_LIST], dtype=np.int64)
+PATH_SIGN = np.array([[-1.0 if inverse else 1.0 for _, inverse in PATH_PAIRS[p]] for p in PATH_LIST])
+
+PATH_ROW = {path: i for i, path in enumerate(PATH_LIST)}  # 路徑 -> 矩陣列號
+
+# 缺價以 NaN 表示，求和時會傳染到整條路徑；買賣方向各存一份簿頂對數價。
+# 原始價另存一份線性陣列，逐腿計算直接以整數索引取值，熱路徑不做字串雜湊
+log_bid_arr = np.full(len(SYMBOL_IDX), np.nan)
+log_ask_arr = np.full(len(SYMBOL_IDX), np.nan)
+bid_price_arr = np.zeros(len(SYMBOL_IDX))
+ask_price_arr = np.zeros(len(SYMBOL_IDX))
+price_stamp_arr = np.zeros(len(SYMBOL_IDX))
+
+# 五檔深度 (價格, 數量) 陣列，收到第一筆深度推送前為 None
+depth_bids = [None] * len(SYMBOL_IDX)
+depth_asks = [None] * len(SYMBOL_IDX)
+
+def update_ticker(ticker):
+    symbol = ticker['s'].lower()
+    price = float(ticker['c'])
+    old_price = prices.get(symbol)
+    prices[symbol] = price
+    price_updated_at[symbol] = time.time()
+    volumes[symbol] = float(ticker['q'])
+    day_opens[symbol] = float(ticker['o'])
+    update_running_stats(symbol, price)
+
+    if symbol in TRACKED_SYMBOLS:
+        if symbol not in bids:
+            # 簿頂報價到位前先以最新成交價墊底，兩個方向共用同一個價
+            idx = SYMBOL_IDX[symbol]
+            log_bid_arr[idx] = log_ask_arr[idx] = math.log(price)
+            bid_price_arr[idx] = ask_price_arr[idx] = price
+            price_stamp_arr[idx] = price_updated_at[symbol]
+        # 每筆報價都寫日誌會佔掉 on_message 大半時間，只在 DEBUG 等級保留
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"📈 {symbol.upper()} 最新價格: {price}")
+        if old_price and abs(price - old_price) / old_price > PRICE_CHANGE_THRESHOLD:
+            opportunity_event.set()
+
+def update_depth(symbol, payload):
+    # 部分深度推送本身不帶交易對名稱，由呼叫端從 stream 名稱解析
+    book_bids = np.array(payload['bids'], np.float64)
+    book_asks = np.array(payload['asks'], np.float64)
+    if not len(book_bids) or not len(book_asks):
+        return
+    bid = book_bids[0, 0]
+    ask = book_asks[0, 0]
+    bids[symbol] = bid
+    asks[symbol] = ask
+    now = time.time()
+    price_updated_at[symbol] = now
+    idx = SYMBOL_IDX.get(symbol)
+    if idx is not None:
+        depth_bids[idx] = book_bids
+        depth_asks[idx] = book_asks
+        log_bid_arr[idx] = math.log(bid)
+        log_ask_arr[idx] = math.log(ask)
+        bid_price_arr[idx] = bid
+        ask_price_arr[idx] = ask
+        price_stamp_arr[idx] = now
+        # 簿頂一變動就喚醒評估執行緒; 掃描已向量化，逐筆觸發負擔得起
+        opportunity_event.set()
+
+def handle_message(message):
+    started = time.perf_counter_ns()
+    try:
+        data = json_loads(message)
+
+        # 合併串流外層帶 stream 名稱；深度推送的交易對只在名稱裡
+        if isinstance(data, dict) and 'stream' in data:
+            if '@depth' in data['stream']:
+                update_depth(data['stream'].split('@', 1)[0], data['data'])
+                return
+            data = data['data']
+
+        if isinstance(data, list):
+            for ticker in data:
+                update_ticker(ticker)
+        elif data.get('e') == 'outboundAccountPosition':
+            update_balances(data['B'])
+        elif data.get('e') in ('executionReport', 'balanceUpdate', 'listStatus'):
+            # userDataStream 的其他事件；餘額一律以 outboundAccountPosition 為準。
+            # executionReport 也帶 s/c (c 是 clientOrderId)，必須先在這裡攔下，
+            # 否則會落進下面的行情分支把訂單編號當價格解析
+            pass
+        elif 's' in data and 'c' in data:
+            update_ticker(data)
+        elif 'result' in data:  # SUBSCRIBE 的確認回應
+            pass
         else:
             logging.warning(f"⚠️ 無法解析 WebSocket 數據: {data}")
 
     except Exception as e:
-        logging.error(f"WebSocket 處理錯誤: {str(e)}")
-
-def on_error(ws, error):
-    logging.error(f"WebSocket 錯誤: {error}")
-
-def on_close(ws, close_status_code, close_msg):
-    logging.warning("WebSocket 連線關閉，嘗試重連...")
-    time.sleep(5)
-    start_websocket()
-
-def on_open(ws):
-    symbols = ["bnbusdt", "btcusdt", "ethusdt"]
-    payload = {
-        "method": "SUBSCRIBE",
-        "params": [f"{symbol}@ticker" for symbol in symbols],
-        "id": 1
-    }
-    ws.send(json.dumps(payload))
-    logging.info("✅ WebSocket 已連接，監聽市場價格")
+        log_exception(f"WebSocket 處理錯誤: {str(e)}")
+    finally:
+        record_latency('行情處理', started)
+
+WEBSOCKET_URL = "wss://stream.binance.com:9443/stream"  # 合併串流端點，推送帶 stream 名稱
+
+_listen_key = None  # userDataStream 的 listenKey，每次連線時換新
+
+def keepalive_user_stream():
+    # listenKey 閒置 60 分鐘會被回收，每 30 分鐘續期一次
+    while True:
+        time.sleep(1800)
+        if _listen_key:
+            try:
+                safe_api_call(client.stream_keepalive, _listen_key)
+            except Exception as e:
+                logging.warning(f"listenKey 續期失敗: {str(e)}")
+
+async def consume_stream():
+    global _listen_key
+    while True:
+        try:
+            # ticker 訊息短小，permessage-deflate 省不了頻寬反而燒 CPU，直接關掉；
+            # max_queue=None 讓推送高峰不會被背壓丟訊息。
+            # websockets 會自動回應 Binance 每 3 分鐘的伺服器 ping，不會因漏 pong 被斷線；
+            # asyncio 傳輸層預設已開 TCP_NODELAY
+            async with websockets.connect(WEBSOCKET_URL, compression=None, max_queue=None,
+                                          ping_interval=WEBSOCKET_PING_INTERVAL,
+                                          ping_timeout=60) as ws:
+                # 全市場 miniTicker 供篩選統計；套利交易對另訂五檔深度，估算滑點；
+                # userDataStream 推送餘額變動，省掉輪詢帳戶的 REST 請求
+                _listen_key = safe_api_call(client.stream_get_listen_key)
+                streams = ["!miniTicker@arr"] + [f"{pair}@depth5@100ms" for pair in sorted(TRACKED_SYMBOLS)] + [_listen_key]
+                await ws.send(json_dumps({"method": "SUBSCRIBE", "params": streams, "id": 1}))
+                logging.info("✅ WebSocket 已連接，監聽全市場價格")
+                async for message in ws:
+                    handle_message(message)
+        except Exception as e:
+            logging.warning(f"WebSocket 連線中斷，5 秒後重連: {str(e)}")
+            await asyncio.sleep(5)
 
 def start_websocket():
-    ws = websocket.WebSocketApp("wss://stream.binance.com:9443/ws",
-                                on_message=on_message,
-                                on_error=on_error,
-                                on_close=on_close)
-    ws.on_open = on_open
-    ws.run_forever()
+    if uvloop is not None:
+        uvloop.install()
+    asyncio.run(consume_stream())
 
 threading.Thread(target=start_websocket, daemon=True).start()
+threading.Thread(target=refresh_exchange_info, daemon=True).start()
+threading.Thread(target=keepalive_user_stream, daemon=True).start()
+
+# ✅ 波動率計算 (Welford 單遍演算法；numba 可用時 JIT 編譯，用於批次初始化統計)
+# 明確簽名讓編譯在 import 時完成並寫入磁碟快取，重新部署不必在第一筆資料上等 JIT
+@njit('UniTuple(float64, 3)(float64[:])', cache=True, fastmath=True)
+def welford_stats(values):
+    n = 0.0
+    mean = 0.0
+    m2 = 0.0
+    for v in values:
+        n += 1.0
+        d = v - mean
+        mean += d / n
+        m2 += d * (v - mean)
+    return n, mean, m2
+
+def calculate_volatility(symbol):
+    # 統計已在 WebSocket 回呼中增量維護，這裡只做 O(1) 讀取
+    n, mean, m2 = running_stats.get(symbol, (0, 0.0, 0.0))
+    if n < 2 or mean == 0:
+        return 0.0
+    return (m2 / n) ** 0.5 / mean
+
+# ✅ 預填歷史價格 (WebSocket 累積足夠資料前先以 K 線補齊；同一次抓取同時取得價格與成交額)
+def get_historical_data(symbol, interval="1m", limit=PRICE_HISTORY_SIZE):
+    klines = safe_api_call(client.get_klines, symbol=symbol.upper(), interval=interval, limit=limit)
+    closes = np.fromiter((float(k[4]) for k in klines), np.float64, len(klines))
+    quote_volumes = np.fromiter((float(k[7]) for k in klines), np.float64, len(klines))
+    return closes, quote_volumes
+
+def seed_symbol_history(symbol):
+    try:
+        closes, quote_volumes = get_historical_data(symbol)
+    except Exception as e:
+        logging.warning(f"⚠️ 預填 {symbol.upper()} 歷史價格失敗: {str(e)}")
+        return
+    price_history[symbol].extend(closes)
+    # 一次算出種子資料的統計量，之後交給 WebSocket 回呼增量維護
+    history = price_history[symbol]
+    n, mean, m2 = welford_stats(np.fromiter(history, np.float64, len(history)))
+    running_stats[symbol][:] = [int(n), mean, m2]
+    # 以近期 K 線成交額換算約略的 24 小時量，WebSocket 推送後即被覆蓋
+    if len(quote_volumes) and symbol not in volumes:
+        volumes[symbol] = quote_volumes.sum() * (1440 / len(quote_volumes))
+
+def seed_price_history():
+    # K 線請求是 IO 密集，並行抓取讓啟動時間不隨交易對數量線性增加
+    list(executor.map(seed_symbol_history, TRACKED_SYMBOLS))
+
+def snapshot_prices():
+    # miniTicker 只推送有變動的交易對，先用單次批次請求把所有價格補滿
+    try:
+        tickers = safe_api_call(client.get_all_tickers, weight=2)
+    except Exception as e:
+        logging.error(f"初始化價格快照失敗: {str(e)}")
+        return
+    now = time.time()
+    for t in tickers:
+        symbol = t['symbol'].lower()
+        if symbol not in prices:
+            prices[symbol] = float(t['price'])
+            price_updated_at[symbol] = now
+            if symbol in TRACKED_SYMBOLS:
+                idx = SYMBOL_IDX[symbol]
+                log_bid_arr[idx] = log_ask_arr[idx] = math.log(prices[symbol])
+                bid_price_arr[idx] = ask_price_arr[idx] = prices[symbol]
+                price_stamp_arr[idx] = now
+
+snapshot_prices()
+seed_price_history()
+
+# ✅ 批次篩選活躍交易對 (直接讀取 WebSocket 推送的本地行情，不發 REST 請求)
+# 篩選條件都是 24 小時統計，變化以秒計；快取幾秒讓逐筆觸發的評估不必每次走訪全市場
+SCREEN_CACHE_TTL = 5
+_screen_cache = {'time': 0.0, 'active': set()}
+
+def screen_active_symbols():
+    now = time.monotonic()
+    if now - _screen_cache['time'] <= SCREEN_CACHE_TTL:
+        return _screen_cache['active']
+    usdt_symbols = get_usdt_symbols()
+    active = set()
+    # WebSocket 執行緒隨時在插入新交易對，先做一次原子快照再迭代，
+    # 避免 dictionary changed size during iteration
+    for symbol, price in list(prices.items()):
+        if symbol not in usdt_symbols:
+            continue
+        open_price = day_opens.get(symbol)
+        if not open_price:
+            continue
+        change_pct = abs(price - open_price) / open_price * 100
+        if volumes.get(symbol, 0) <= MIN_QUOTE_VOLUME or change_pct <= MIN_PRICE_CHANGE_PCT:
+            continue
+        # 歷史價格足夠時再以波動率過濾，避免剛啟動時全數被擋掉
+        history = price_history.get(symbol)
+        if history and len(history) >= MIN_VOLATILITY_SAMPLES and calculate_volatility(symbol) < MIN_VOLATILITY:
+            continue
+        active.add(symbol)
+    _screen_cache['active'] = active
+    _screen_cache['time'] = now
+    return active
+
+def is_path_active(path, active_symbols):
+    return all(f"{asset}USDT".lower() in active_symbols for asset in path if asset != 'USDT')
+
+# ✅ 帳戶餘額與交易金額 (REST 只取初始快照，之後由 userDataStream 推送維護)
+BALANCE_CACHE_TTL = 1.0  # 推送尚未就緒時的 REST 快取時間(秒)
+
+_balance_cache = {'time': 0.0, 'balances': None, 'stream_live': False}
+
+def invalidate_balance_cache():
+    _balance_cache['balances'] = None
+
+def update_balances(entries):
+    # outboundAccountPosition 只帶有變動的資產，逐筆覆蓋本地快照
+    balances = _balance_cache['balances']
+    if balances is None:
+        return  # 還沒有初始快照可更新，下次讀取時整份重抓
+    for entry in entries:
+        balances[entry['a']] = float(entry['f'])
+    _balance_cache['time'] = time.monotonic()
+    _balance_cache['stream_live'] = True
+
+def get_all_balances():
+    now = time.monotonic()
+    # 推送就緒後快照永遠是最新的，只有被 invalidate 時才重抓
+    if _balance_cache['balances'] is None or (
+            not _balance_cache['stream_live'] and now - _balance_cache['time'] > BALANCE_CACHE_TTL):
+        try:
+            account = safe_api_call(client.get_account, weight=10)
+        except Exception as e:
+            log_exception(f"查詢帳戶餘額失敗: {str(e)}")
+            return _balance_cache['balances'] or {}
+        _balance_cache['balances'] = {b['asset']: float(b['free']) for b in account['balances']}
+        _balance_cache['time'] = now
+    return _balance_cache['balances']
+
+def get_account_balance(asset='USDT'):
+    return get_all_balances().get(asset, 0.0)
+
+def get_trade_amount():
+    balance = get_account_balance('USDT')
+    if balance < MIN_TRADE_AMOUNT:
+        return 0.0
+    return min(balance, MAX_TRADE_AMOUNT)
+
+# ✅ 計算套利利潤 (逐腿沿五檔深度試算成交，把滑點算進預期利潤)
+def fill_sell(levels, base_qty):
+    # 沿買方掛單往下吃，回傳換得的報價資產；五檔內吃不完回 0
+    out = 0.0
+    remaining = base_qty
+    for k in range(levels.shape[0]):
+        take = remaining if remaining < levels[k, 1] else levels[k, 1]
+        out += take * levels[k, 0]
+        remaining -= take
+        if remaining <= 0.0:
+            return out
+    return 0.0
+
+def fill_buy(levels, quote_amount):
+    # 沿賣方掛單往上吃，回傳換得的基準資產；五檔內吃不完回 0
+    out = 0.0
+    remaining = quote_amount
+    for k in range(levels.shape[0]):
+        level_quote = levels[k, 0] * levels[k, 1]
+        take = remaining if remaining < level_quote else level_quote
+        out += take / levels[k, 0]
+        remaining -= take
+        if remaining <= 0.0:
+            return out
+    return 0.0
+
+def simulate_path(path, initial_amount):
+    # 逐腿試算成交，回傳 (最終金額, 各腿投入金額)；任一腿不可行回 (0, None)。
+    # 各腿投入量也供下單前的預檢使用，測試單才會帶到真實規模的數量
+    row = PATH_ROW.get(tuple(path))
+    if row is None or initial_amount <= 0:
+        return 0, None
+    amount = initial_amount
+    leg_amounts = []
+    compiled = PATH_PAIRS[tuple(path)]
+    indices = PATH_INDEX[row]
+    now = time.time()
+
+    for j, (pair, inverse) in enumerate(compiled):
+        idx = indices[j]
+        leg_amounts.append(amount)
+
+        # 報價太舊代表行情可能斷線，寧可錯過也不要用舊價下單
+        if now - price_stamp_arr[idx] > PRICE_STALENESS_LIMIT:
+            logging.warning(f"⚠️ {pair.upper()} 的價格已超過 {PRICE_STALENESS_LIMIT} 秒未更新")
+            return 0, None
+
+        levels = depth_asks[idx] if inverse else depth_bids[idx]
+        if levels is not None:
+            # 賣出沿買方掛單往下吃、買入沿賣方掛單往上吃
+            filled = fill_buy(levels, amount) if inverse else fill_sell(levels, amount)
+            if filled <= 0:
+                # 五檔內吃不完代表滑點已不可控，直接放棄
+                return 0, None
+            amount = filled * FEE_MULT
+        else:
+            # 還沒收到深度推送前退回簿頂單一價
+            price = ask_price_arr[idx] if inverse else bid_price_arr[idx]
+            if price <= 0:
+                logging.warning(f"⚠️ 缺少 {pair} 的價格")
+                return 0, None
+            rate = 1.0 / price if inverse else price
+            amount *= rate * FEE_MULT
+
+    return amount, leg_amounts
+
+# ✅ 交易紀錄批次寫入 Google Sheets (先進佇列，背景執行緒整批寫入，不阻塞交易)
+SHEETS_FLUSH_INTERVAL = 5  # 收到第一列後最多等多久就寫入(秒)
+SHEETS_MAX_BATCH = 50  # 單次批次寫入的最大列數
+
+trade_log_queue = queue.Queue()
+
+def log_trade(path_label, profit):
+    # 交易執行緒只記下時間戳，strftime 留給背景寫入執行緒做
+    trade_log_queue.put((time.time(), path_label, round(profit, 6)))
+
+def format_trade_row(entry):
+    ts, path_label, profit = entry
+    return [datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'), path_label, profit]
+
+def flush_trade_logs():
+    while True:
+        # 沒有資料就一直等，收到第一列後再湊批: 滿 SHEETS_MAX_BATCH 列或滿時限就寫
+        entries = [trade_log_queue.get()]
+        deadline = time.monotonic() + SHEETS_FLUSH_INTERVAL
+        while len(entries) < SHEETS_MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                entries.append(trade_log_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            gsheet.append_rows([format_trade_row(e) for e in entries], value_input_option='RAW')
+        except Exception as e:
+            log_exception(f"寫入 Google Sheets 失敗: {str(e)}")
 
-# ✅ 計算套利利潤
-def calculate_profit(path):
-    amount = MIN_TRADE_AMOUNT
-    initial_amount = amount
-
-    for i in range(len(path) - 1):
-        symbol = f"{path[i]}{path[i+1]}".lower()
-        price = prices.get(symbol)
-
-        if not price:
-            logging.warning(f"⚠️ 缺少 {symbol} 的價格")
-            return 0
+threading.Thread(target=flush_trade_logs, daemon=True).start()
 
-        amount *= price * (1 - TRADE_FEE)
+def flush_pending_trades():
+    # 行程結束時把佇列裡還沒寫出的紀錄排空，正常關機不掉單
+    entries = []
+    while True:
+        try:
+            entries.append(trade_log_queue.get_nowait())
+        except queue.Empty:
+            break
+    if entries:
+        try:
+            gsheet.append_rows([format_trade_row(e) for e in entries], value_input_option='RAW')
+        except Exception as e:
+            logging.error(f"關機前寫入 Google Sheets 失敗: {str(e)}")
 
-    profit = amount - initial_amount
-    return profit if profit > MIN_PROFIT_THRESHOLD else 0
+atexit.register(flush_pending_trades)
 
 # ✅ 執行交易
-def execute_trade(path):
-    logging.info(f"🚀 嘗試執行套利: {' → '.join(path)}")
-    profit = calculate_profit(path)
-
-    if profit > 0:
-        logging.info(f"💰 套利成功，預計利潤: {profit:.2f} USDT")
-        return True
-    else:
+def path_orders(path):
+    # 正向掛牌 = 賣出基準資產；只有反向掛牌時 = 用報價資產買入
+    return [(pair.upper(), 'BUY' if inverse else 'SELL') for pair, inverse in PATH_PAIRS.get(tuple(path), [])]
+
+def preflight_path(path, leg_amounts):
+    # 各腿的測試單彼此獨立，並行送出；任何一腿會被拒單就整條路徑放棄。
+    # 數量帶試算出的逐腿投入量，並用與實單相同的對齊規則，預檢才測得到真實規模
+    def check(leg, leg_amount):
+        symbol, side = leg
+        if side == 'BUY':
+            safe_api_call(client.create_test_order, symbol=symbol, side=side, type='MARKET', quoteOrderQty=quantize_quote(symbol, leg_amount))
+        else:
+            safe_api_call(client.create_test_order, symbol=symbol, side=side, type='MARKET', quantity=quantize_base(symbol, leg_amount))
+
+    futures = [executor.submit(check, leg, leg_amount)
+               for leg, leg_amount in zip(path_orders(path), leg_amounts)]
+    for future in futures:
+        future.result()
+
+def fill_commission(order, asset):
+    # 成交回報的數量是毛額；累加以指定資產收取的手續費 (以 BNB 折抵時不扣入帳資產)
+    total = 0.0
+    for fill in order.get('fills', []):
+        if fill.get('commissionAsset') == asset:
+            total += float(fill.get('commission', 0))
+    return total
+
+def execute_trade(path, initial_amount):
+    path_label = PATH_LABELS.get(tuple(path), ' → '.join(path))
+    logging.info(f"🚀 嘗試執行套利: {path_label}")
+    final_amount, leg_amounts = simulate_path(path, initial_amount)
+    profit = final_amount - initial_amount
+
+    if final_amount <= 0 or profit <= MIN_PROFIT_THRESHOLD:
         logging.warning("⚠️ 沒有套利機會")
         return False
 
-# ✅ 選擇最佳套利路徑
-def find_best_arbitrage():
-    best_path, best_profit = None, 0
-    for path in TRADE_PATHS:
-        profit = calculate_profit(path)
-        if profit > best_profit:
-            best_path, best_profit = path, profit
-    return best_path if best_profit > 0 else None
-
-# ✅ 主循環
-while True:
-    path = find_best_arbitrage()
-    if path:
-        execute_trade(path)
-    time.sleep(5)
+    amount = initial_amount
+    try:
+        preflight_path(path, leg_amounts)
+    except Exception as e:
+        logging.warning(f"⚠️ 路徑預檢失敗，放棄執行: {str(e)}")
+        return False
+
+    started = time.perf_counter_ns()
+    try:
+        # 每一腿都依賴上一腿的成交結果，只能依序送出
+        for j, (symbol, side) in enumerate(path_orders(path)):
+            if side == 'BUY':
+                order = safe_api_call(client.order_market_buy, symbol=symbol, quoteOrderQty=quantize_quote(symbol, amount))
+                amount = float(order.get('executedQty', 0))
+            else:
+                order = safe_api_call(client.order_market_sell, symbol=symbol, quantity=quantize_base(symbol, amount))
+                amount = float(order.get('cummulativeQuoteQty', 0))
+            # 下一腿只能花實際到帳的量: 扣掉以入帳資產 (path[j+1]) 收取的手續費
+            amount -= fill_commission(order, path[j + 1])
+    except Exception as e:
+        log_exception(f"❌ 下單失敗: {str(e)}")
+        return False
+    finally:
+        invalidate_balance_cache()
+        record_latency('下單往返', started)
+
+    # 實際利潤直接取最後一腿的成交回報，不再重新抓價計算
+    actual_profit = amount - initial_amount
+    logging.info(f"💰 套利完成，實際利潤: {actual_profit:.2f} USDT (預估 {profit:.2f})")
+    log_trade(path_label, actual_profit)
+    return True
+
+# ✅ 市場狀況檢查 (BTC 近期振幅過大時暫停交易，滑點模型會失真)
+MAX_MARKET_VOLATILITY = 0.05  # BTC 近期最高最低價差 / 最低價 的上限
+
+def check_market_conditions():
+    history = price_history.get('btcusdt')
+    if not history or len(history) < MIN_VOLATILITY_SAMPLES:
+        return True
+    closes = np.fromiter(history, np.float64, len(history))
+    swing = (closes.max() - closes.min()) / closes.min()
+    if swing > MAX_MARKET_VOLATILITY:
+        logging.warning(f"⚠️ 市場波動過大 (BTC 振幅 {swing:.2%})，暫停套利")
+        return False
+    return True
+
+# ✅ 選擇最佳套利路徑 (對數空間比較: 路徑報酬由 numba 核心一次算完)
+LOG_FEE = math.log(FEE_MULT)  # 每一腿的手續費在對數空間是固定加項
+
+# 指定簽名讓編譯在 import 時完成；路徑數擴到全市場三角掃描時仍是單一原生迴圈
+@njit('float64[:](float64[:], float64[:], float64[:], float64, int64[:,:], float64[:,:], float64)', cache=True, fastmath=True)
+def path_log_profits(log_bids, log_asks, stamps, oldest_ok, indices, signs, log_fee):
+    n_paths, n_legs = indices.shape
+    totals = np.empty(n_paths)
+    for i in range(n_paths):
+        total = n_legs * log_fee
+        for j in range(n_legs):
+            idx = indices[i, j]
+            # 過期報價直接讓整條路徑失格
+            if stamps[idx] < oldest_ok:
+                total = np.nan
+                break
+            # 正向腿是賣出、吃 bid；反向腿是買入、吃 ask 的倒數
+            if signs[i, j] > 0.0:
+                total += log_bids[idx]
+            else:
+                total -= log_asks[idx]
+        totals[i] = total
+    return totals
+
+def find_best_arbitrage(initial_amount):
+    active_symbols = screen_active_symbols()
+    now = time.time()
+    totals = path_log_profits(log_bid_arr, log_ask_arr, price_stamp_arr, now - PRICE_STALENESS_LIMIT,
+                              PATH_INDEX, PATH_SIGN, LOG_FEE)
+
+    threshold_log = math.log(1 + MIN_PROFIT_THRESHOLD / initial_amount)
+    best_path, best_log = None, threshold_log
+    for i, path in enumerate(PATH_LIST):
+        total = totals[i]
+        if math.isnan(total) or total <= best_log:
+            continue
+        if is_path_active(path, active_symbols):
+            best_path, best_log = path, total
+    return best_path
+
+# ✅ 主循環 (完全事件驅動: 只在收到新報價時評估，沒有固定輪詢間隔)
+_stop_requested = threading.Event()  # /stop 設定後立即喚醒並結束主循環
+
+def run_arbitrage():
+    while not _stop_requested.is_set():
+        opportunity_event.wait()
+        opportunity_event.clear()
+        if _stop_requested.is_set():
+            break
+        if not check_market_conditions():
+            continue
+        # 餘額在這裡查一次，整輪評估與下單共用同一個數字
+        initial_amount = get_trade_amount()
+        if initial_amount <= 0:
+            continue
+        started = time.perf_counter_ns()
+        path = find_best_arbitrage(initial_amount)
+        record_latency('路徑決策', started)
+        if path:
+            execute_trade(path, initial_amount)
+
+# 保證全程只有一條套利執行緒，重複呼叫 /start 不會多開
+_arbitrage_lock = threading.Lock()
+_arbitrage_thread = None
+
+def start_arbitrage():
+    global _arbitrage_thread
+    with _arbitrage_lock:
+        if _arbitrage_thread is None or not _arbitrage_thread.is_alive():
+            _stop_requested.clear()
+            _arbitrage_thread = threading.Thread(target=run_arbitrage, daemon=True)
+            _arbitrage_thread.start()
+            return True
+    return False
+
+def stop_arbitrage():
+    # 設定停止旗標後立刻喚醒，主循環不會卡在等待下一筆報價
+    _stop_requested.set()
+    opportunity_event.set()
+
+start_arbitrage()
+
+# ✅ Flask 路由 (設定 API_AUTH_TOKEN 時啟用驗證；密鑰在 import 時讀一次成 bytes)
+_API_AUTH_TOKEN = (os.getenv('API_AUTH_TOKEN') or '').encode()
+
+def require_auth(func):
+    @wraps(func)
+    def decorated(*args, **kwargs):
+        if _API_AUTH_TOKEN:
+            header = request.headers.get('Authorization', '')
+            token = header[7:] if header.startswith('Bearer ') else header
+            if not hmac.compare_digest(token.encode(), _API_AUTH_TOKEN):
+                return jsonify({'error': 'unauthorized'}), 401
+        return func(*args, **kwargs)
+    return decorated
+
+@app.route('/start')
+@require_auth
+def start():
+    started = start_arbitrage()
+    return jsonify({'status': 'started' if started else 'already_running'})
+
+# 探針高頻打進來，回應用預先編好的位元組，不經過 jsonify 的逐請求序列化
+_HEALTH_OK = (b'{"status":"ok"}', 200, {'Content-Type': 'application/json'})
+
+@app.route('/health')
+def health():
+    return _HEALTH_OK
+
+@app.route('/stop')
+@require_auth
+def stop():
+    stop_arbitrage()
+    return jsonify({'status': 'stopping'})
+
+@app.route('/status')
+@require_auth
+def status():
+    # 兩筆餘額查詢並行送出，回應時間取最慢的一筆而不是總和
+    usdt_future = executor.submit(get_account_balance, 'USDT')
+    bnb_future = executor.submit(get_account_balance, 'BNB')
+    return jsonify({
+        'running': _arbitrage_thread is not None and _arbitrage_thread.is_alive(),
+        'usdt_balance': usdt_future.result(),
+        'bnb_balance': bnb_future.result(),
+        'tracked_symbols': sorted(pair.upper() for pair in TRACKED_SYMBOLS),
+    })
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=int(os.getenv('PORT', 8080)))
+    from waitress import serve
+    serve(app, host='0.0.0.0', port=int(os.getenv('PORT', 8080)), threads=8)